@@ -1,10 +1,158 @@
 """Custom embedder using BGE Large model for open-source embedding."""
 
 from typing import List, Optional, Union
+import json
+import os
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
-import time
-from requests.exceptions import ChunkedEncodingError
+from sentence_transformers.models import Pooling
+from tenacity import (
+    retry,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+from transformers import AutoTokenizer
+
+from embedding_cache import EmbeddingCache
+from prompts import BGE_PROMPT
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "agentic_rag", "onnx")
+
+# Written last into an ONNX export dir; records the resolved pooling settings
+ONNX_EXPORT_MARKER = "embedder_config.json"
+
+# sentence-transformers module type that holds the pooling settings
+_POOLING_MODULE_TYPE = "sentence_transformers.models.Pooling"
+
+
+def _default_num_threads() -> int:
+    """Number of CPUs this process can actually use, capped at physical cores.
+
+    Respects the CPU affinity mask and a cgroup v2 CPU quota, and avoids
+    oversubscribing SMT siblings when psutil can report physical cores.
+    """
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on macOS/Windows
+        n = os.cpu_count() or 1
+
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            n = min(n, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+
+    try:
+        import psutil
+
+        physical = psutil.cpu_count(logical=False)
+        if physical:
+            n = min(n, physical)
+    except ImportError:
+        pass
+
+    return max(1, n)
+
+
+# Thread count for CPU inference, overridable with BGE_NUM_THREADS
+NUM_THREADS = int(os.environ.get("BGE_NUM_THREADS", 0)) or _default_num_threads()
+
+# Model downloads can fail transiently; retry with jittered exponential backoff
+MAX_LOAD_ATTEMPTS = 3
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _masked_mean_norm_kernel(hidden, mask, out):
+        """Mean-pool token embeddings over the attention mask and L2-normalize."""
+        n, t, d = hidden.shape
+        for i in prange(n):
+            out[i, :] = 0.0
+            count = 0.0
+            for j in range(t):
+                if mask[i, j]:
+                    count += 1.0
+                    for k in range(d):
+                        out[i, k] += hidden[i, j, k]
+            count = max(count, 1.0)
+            norm = 0.0
+            for k in range(d):
+                out[i, k] /= count
+                norm += out[i, k] * out[i, k]
+            inv = 1.0 / np.sqrt(norm) if norm > 0.0 else 0.0
+            for k in range(d):
+                out[i, k] *= inv
+
+
+def _cpu_supports_bf16() -> bool:
+    """Whether the CPU has native BF16 matmul support (AVX512-BF16 or AMX).
+
+    Without it BF16 runs through emulated paths that are slower than FP32.
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def _pooling_mode_from_config(config: dict) -> str:
+    """Map a sentence-transformers Pooling config to "cls" or "mean"."""
+    if config.get("pooling_mode_cls_token"):
+        return "cls"
+    if config.get("pooling_mode_mean_tokens"):
+        return "mean"
+    raise ValueError(f"Unsupported pooling configuration: {config}")
+
+
+def _read_json(source: str, filename: str) -> Optional[dict]:
+    """Read a JSON file from a local model directory or the Hugging Face Hub.
+
+    Returns None if the file does not exist.
+    """
+    if os.path.isdir(source):
+        path = os.path.join(source, filename)
+        if not os.path.exists(path):
+            return None
+    else:
+        from huggingface_hub import hf_hub_download
+        from huggingface_hub.utils import EntryNotFoundError
+
+        try:
+            path = hf_hub_download(source, filename)
+        except EntryNotFoundError:
+            return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _masked_mean_norm(hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Mean-pool (N, T, D) hidden states over the mask and L2-normalize.
+
+    Uses a single fused Numba kernel when numba is installed, which avoids
+    allocating the masked (N, T, D) intermediate.
+    """
+    if njit is not None:
+        out = np.empty((hidden.shape[0], hidden.shape[2]), dtype=np.float32)
+        _masked_mean_norm_kernel(np.ascontiguousarray(hidden), np.ascontiguousarray(mask), out)
+        return out
+
+    mask = mask[:, :, None].astype(np.float32)
+    pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+    # Leave all-zero rows (e.g. an empty mask) at zero, as the kernel does
+    norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+    return np.divide(pooled, norms, out=np.zeros_like(pooled), where=norms > 0)
+
 
 class BGEEmbedder:
     """Embedder using BGE Large model.
@@ -18,6 +166,12 @@ class BGEEmbedder:
         model_name: str = "BAAI/bge-large-en-v1.5",
         dimensions: Optional[int] = 1024,
         device: str = "cpu",
+        batch_size: int = 32,
+        half_precision: bool = True,
+        backend: str = "torch",
+        onnx_cache_dir: Optional[str] = None,
+        cache_size: int = 50_000,
+        compile_model: bool = False,
     ):
         """Initialize the embedder with the BGE Large model.
         
@@ -26,27 +180,80 @@ class BGEEmbedder:
                 Default is "BAAI/bge-large-en-v1.5" (1024 dimensions).
             dimensions: Expected embedding dimensions (for validation).
                 If None, no validation is performed.
-            device: Device to run the model on ("cpu" or "cuda").
+            device: Device to run the model on ("cpu" or "cuda"). The "onnx"
+                backend only runs on CPU.
+            batch_size: Number of texts passed to the model per forward pass.
+                Texts are length-sorted before batching to keep padding small.
+                Activation memory grows with batch_size * seq_len^2, so keep
+                this modest for long inputs.
+            half_precision: Run the model in reduced precision. Weights are
+                cast to FP16 on CUDA; on CPU encoding runs under BF16 autocast,
+                but only if the CPU supports BF16 natively (AVX512-BF16 or AMX).
+                Only applies to the "torch" backend.
+            backend: Inference runtime, "torch" (sentence-transformers) or
+                "onnx" (ONNX Runtime on CPU, requires optimum[onnxruntime]).
+            onnx_cache_dir: Directory holding the exported ONNX model. The model
+                is exported once on first use. Defaults to ~/.cache/agentic_rag/onnx.
+            cache_size: Number of embeddings kept in the in-process LRU cache.
+                0 disables caching.
+            compile_model: Compile the model with torch.compile and warm it up
+                at construction. Speeds up encoding at the cost of a slow start.
+                Only applies to the "torch" backend.
         """
-        max_retries = 3
-        retry_delay = 2
-        
-        for attempt in range(max_retries):
-            try:
-                self.model = SentenceTransformer(model_name, device=device)
-                break
-            except (ChunkedEncodingError, Exception) as e:
-                if attempt == max_retries - 1:
-                    raise Exception(f"Failed to load model after {max_retries} attempts: {str(e)}")
-                time.sleep(retry_delay * (attempt + 1))
-        
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Unsupported backend: {backend}. Use 'torch' or 'onnx'.")
+        if backend == "onnx" and torch.device(device).type != "cpu":
+            raise ValueError(f"The 'onnx' backend only supports device='cpu', got {device!r}.")
+
         self.model_name = model_name
         self.dimensions = dimensions
         self.device = device
+        # "cuda", "cuda:0" etc. all map to "cuda"
+        self._device_type = torch.device(device).type
+        self.batch_size = batch_size
+        self.half_precision = half_precision
+        self.backend = backend
+        self._cpu_autocast = half_precision and self._device_type == "cpu" and _cpu_supports_bf16()
+        # Both backends read these from the model's sentence-transformers config
+        self.pooling_mode = "cls"
+        self.max_seq_length = 512
+        self._cache = EmbeddingCache(max_size=cache_size)
+        # Side stream for overlapping host-to-device copies with compute
+        self._copy_stream = (
+            torch.cuda.Stream(device=self.device)
+            if backend == "torch" and self._device_type == "cuda"
+            else None
+        )
+
+        # torch.set_num_threads sizes both torch's OpenMP and MKL pools; the
+        # ONNX backend sizes its own session instead
+        if backend == "torch" and self._device_type == "cpu":
+            torch.set_num_threads(NUM_THREADS)
+            try:
+                torch.set_num_interop_threads(max(1, NUM_THREADS // 4))
+            except RuntimeError:
+                # Can only be set once, before any inter-op work has started
+                pass
+
+        try:
+            self._load_model(onnx_cache_dir or ONNX_CACHE_DIR)
+        except (ImportError, ValueError):
+            raise
+        except Exception as e:
+            raise Exception(f"Failed to load model after {MAX_LOAD_ATTEMPTS} attempts: {str(e)}")
+
+        if backend == "torch":
+            if half_precision and self._device_type == "cuda":
+                self.model = self.model.half()
+
+            self._enable_fused_attention()
+
+            if compile_model:
+                self._compile_model()
         
         # Validate dimensions if specified
         if dimensions is not None:
-            actual_dims = self.model.get_sentence_embedding_dimension()
+            actual_dims = self.get_dimensions()
             if actual_dims != dimensions:
                 raise ValueError(
                     f"Model {model_name} produces embeddings with {actual_dims} dimensions, "
@@ -63,20 +270,258 @@ class BGEEmbedder:
             If a single text is provided, returns a single embedding vector as a list of floats.
             If multiple texts are provided, returns a list of embedding vectors.
         """
+        return self.embed_np(texts).tolist()
+
+    def embed_np(self, texts: Union[str, List[str]]) -> np.ndarray:
+        """Generate embeddings as a float32 array for the given text(s).
+
+        Prefer this over embed when the caller can work with arrays, as it
+        avoids materializing every component as a Python float.
+
+        Args:
+            texts: A single text string or a list of text strings to embed.
+
+        Returns:
+            If a single text is provided, returns a (D,) array.
+            If multiple texts are provided, returns a contiguous (N, D) array.
+        """
         # BGE models work best with a specific prompt template
         if isinstance(texts, str):
             # Single text
-            text_to_embed = f"Represent this sentence for searching relevant passages: {texts}"
-            embedding = self.model.encode(text_to_embed)
-            return embedding.tolist()
+            text_to_embed = BGE_PROMPT + texts
+            return self._cache.get_or_compute([text_to_embed], self._encode)[0]
         else:
             # List of texts
-            texts_to_embed = [f"Represent this sentence for searching relevant passages: {text}" for text in texts]
-            embeddings = self.model.encode(texts_to_embed)
-            return [emb.tolist() for emb in embeddings]
+            if not texts:
+                return np.empty((0, self.get_dimensions()), dtype=np.float32)
+            texts_to_embed = [BGE_PROMPT + text for text in texts]
+            return self._cache.get_or_compute(texts_to_embed, self._encode)
+
+    @retry(
+        # Missing optional packages and bad model configs won't fix themselves
+        retry=retry_if_not_exception_type((ImportError, ValueError)),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(MAX_LOAD_ATTEMPTS),
+        reraise=True,
+    )
+    def _load_model(self, onnx_cache_dir: str):
+        """Load the model for the configured backend, retrying on failure."""
+        if self.backend == "onnx":
+            self._load_onnx_model(onnx_cache_dir)
+        else:
+            self._load_torch_model()
+
+    def _load_torch_model(self):
+        """Load the sentence-transformers model and reuse its tokenizer."""
+        self.model = SentenceTransformer(self.model_name, device=self.device)
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = self.model.max_seq_length
+
+        pooling = next((module for module in self.model if isinstance(module, Pooling)), None)
+        if pooling is not None:
+            self.pooling_mode = _pooling_mode_from_config(pooling.get_config_dict())
+
+    def _enable_fused_attention(self):
+        """Swap the encoder's attention for fused SDPA kernels when available.
+
+        Uses Optimum's BetterTransformer if it is installed. Newer transformers
+        releases already default BERT to SDPA, in which case the transform is
+        rejected and the model is left as is.
+        """
+        try:
+            from optimum.bettertransformer import BetterTransformer
+        except ImportError:
+            return
+
+        transformer = self.model._first_module()
+        try:
+            transformer.auto_model = BetterTransformer.transform(transformer.auto_model)
+        except Exception:
+            pass
+
+    def _compile_model(self):
+        """Compile the underlying model, falling back to eager mode on failure.
+
+        Compilation happens on the first forward pass, so a warmup batch is run
+        here rather than on the first real request. dynamic=True avoids
+        recompiling for every padded sequence length.
+        """
+        transformer = self.model._first_module()
+        eager_model = transformer.auto_model
+        try:
+            transformer.auto_model = torch.compile(eager_model, mode="max-autotune", dynamic=True)
+            self._encode(["warmup"] * 8)
+        except Exception:
+            transformer.auto_model = eager_model
+
+    def _load_onnx_model(self, cache_dir: str):
+        """Load the ONNX export of the model, exporting it on first use.
+
+        An export is only reused if its ONNX_EXPORT_MARKER file exists. The
+        marker is written last and records the resolved pooling settings, so
+        an interrupted export (or one without recorded settings) is redone
+        rather than guessed at.
+        """
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = NUM_THREADS
+
+        model_dir = os.path.join(cache_dir, self.model_name.replace("/", "--"))
+        marker_path = os.path.join(model_dir, ONNX_EXPORT_MARKER)
+        if os.path.exists(marker_path):
+            with open(marker_path) as f:
+                settings = json.load(f)
+            self.pooling_mode = settings["pooling_mode"]
+            self.max_seq_length = settings["max_seq_length"]
+            self.model = ORTModelForFeatureExtraction.from_pretrained(
+                model_dir,
+                provider="CPUExecutionProvider",
+                session_options=session_options,
+            )
+            self.tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+        else:
+            self._apply_sentence_transformers_config(self.model_name)
+            self.model = ORTModelForFeatureExtraction.from_pretrained(
+                self.model_name,
+                export=True,
+                provider="CPUExecutionProvider",
+                session_options=session_options,
+            )
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+            self.model.save_pretrained(model_dir)
+            self.tokenizer.save_pretrained(model_dir)
+            with open(marker_path, "w") as f:
+                json.dump({"pooling_mode": self.pooling_mode, "max_seq_length": self.max_seq_length}, f)
+
+    def _apply_sentence_transformers_config(self, source: str):
+        """Set pooling_mode and max_seq_length from a sentence-transformers config.
+
+        The ONNX export only contains the transformer, so these settings are
+        read from modules.json, the Pooling module config and
+        sentence_bert_config.json, matching what SentenceTransformer would load.
+        Models without a modules.json get mean pooling, as SentenceTransformer
+        does for plain transformers checkpoints.
+        """
+        modules = _read_json(source, "modules.json")
+        self.pooling_mode = "mean"
+        for module in modules or []:
+            if module.get("type") == _POOLING_MODULE_TYPE:
+                pooling_config = _read_json(source, f"{module['path']}/config.json")
+                if pooling_config is None:
+                    raise ValueError(f"Model {source} has a Pooling module but no pooling config.")
+                self.pooling_mode = _pooling_mode_from_config(pooling_config)
+
+        sbert_config = _read_json(source, "sentence_bert_config.json") or {}
+        if sbert_config.get("max_seq_length"):
+            self.max_seq_length = sbert_config["max_seq_length"]
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts into a (N, D) array of normalized embeddings.
+
+        Texts are sorted by length so each batch is padded only to the length
+        of its longest member, then results are scattered back to input order.
+        """
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        embeddings = np.empty((len(texts), self.get_dimensions()), dtype=np.float32)
+        batches = [order[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+
+        if self.backend == "onnx":
+            for batch_idx in batches:
+                embeddings[batch_idx] = self._encode_onnx_batch([texts[i] for i in batch_idx])
+            return embeddings
+
+        # Forward passes are queued asynchronously on CUDA, so the next batch is
+        # tokenized and copied to the device before waiting on the current one.
+        next_inputs = self._prepare_inputs([texts[i] for i in batches[0]]) if batches else None
+        for b, batch_idx in enumerate(batches):
+            pooled = self._forward(*next_inputs)
+            if b + 1 < len(batches):
+                next_inputs = self._prepare_inputs([texts[i] for i in batches[b + 1]])
+            embeddings[batch_idx] = pooled.cpu().numpy()
+
+        return embeddings
+
+    def _prepare_inputs(self, texts: List[str]):
+        """Tokenize a batch and start moving it to the model's device.
+
+        On CUDA the tensors are pinned and copied with non_blocking=True on a
+        side stream, so the transfer overlaps with compute on the main stream.
+
+        Returns:
+            The device tensors and a CUDA event marking copy completion (None on CPU).
+        """
+        encoded = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="pt",
+        )
+        if self._copy_stream is None:
+            return encoded.to(self.device), None
+
+        with torch.cuda.stream(self._copy_stream):
+            on_device = {
+                name: tensor.pin_memory().to(self.device, non_blocking=True)
+                for name, tensor in encoded.items()
+            }
+            copied = torch.cuda.Event()
+            copied.record(self._copy_stream)
+        return on_device, copied
+
+    def _forward(self, encoded, copied=None) -> torch.Tensor:
+        """Run one batch through the underlying Hugging Face model.
+
+        Returns:
+            The pooled, L2-normalized float32 embeddings, still on the device.
+        """
+        if copied is not None:
+            # Without a device argument this would be cuda:0's stream
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(copied)
+            for tensor in encoded.values():
+                # Tensors were allocated on the copy stream
+                tensor.record_stream(stream)
+
+        auto_model = self.model._first_module().auto_model
+
+        with torch.inference_mode(), torch.autocast(
+            "cpu",
+            dtype=torch.bfloat16,
+            enabled=self._cpu_autocast,
+        ):
+            hidden = auto_model(**encoded).last_hidden_state
+
+            if self.pooling_mode == "cls":
+                pooled = hidden[:, 0].float()
+            else:
+                mask = encoded["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                pooled = ((hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)).float()
+            return torch.nn.functional.normalize(pooled, dim=1)
+
+    def _encode_onnx_batch(self, texts: List[str]) -> np.ndarray:
+        """Run one batch through the ONNX Runtime session."""
+        encoded = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np",
+        )
+        hidden = np.asarray(self.model(**encoded).last_hidden_state, dtype=np.float32)
+
+        if self.pooling_mode == "mean":
+            return _masked_mean_norm(hidden, encoded["attention_mask"])
+        pooled = hidden[:, 0]
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
     
     def get_dimensions(self) -> int:
         """Get the dimensions of the embeddings produced by this model."""
+        if self.backend == "onnx":
+            return self.model.config.hidden_size
         return self.model.get_sentence_embedding_dimension()
         
     def id(self) -> str:
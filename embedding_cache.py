@@ -0,0 +1,113 @@
+"""In-process LRU cache for text embeddings."""
+
+from collections import OrderedDict
+from typing import Awaitable, Callable, List
+import hashlib
+import numpy as np
+
+
+class EmbeddingCache:
+    """LRU cache mapping text to its embedding vector.
+
+    Texts are keyed by a 16-byte BLAKE2b digest so long documents don't have
+    to be kept in memory as dictionary keys.
+    """
+
+    def __init__(self, max_size: int = 50_000):
+        """Initialize the cache.
+
+        Args:
+            max_size: Maximum number of embeddings to keep. The least recently
+                used entry is evicted when the cache is full. 0 disables caching.
+        """
+        self.max_size = max_size
+        self._entries: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        """Return the cache key for a text."""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get_or_compute(
+        self,
+        texts: List[str],
+        compute: Callable[[List[str]], np.ndarray],
+    ) -> np.ndarray:
+        """Return embeddings for texts, computing only the ones not cached.
+
+        Args:
+            texts: Texts to look up.
+            compute: Function mapping a list of texts to a (N, D) array of
+                embeddings. Called at most once, with duplicates removed.
+
+        Returns:
+            A (len(texts), D) array of embeddings in input order.
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        keys, results, misses = self._lookup(texts)
+        if misses:
+            self._fill(keys, results, misses, compute(list(misses.values())))
+        return np.stack(results)
+
+    async def aget_or_compute(
+        self,
+        texts: List[str],
+        compute: Callable[[List[str]], Awaitable[np.ndarray]],
+    ) -> np.ndarray:
+        """Async version of get_or_compute, for a coroutine compute function."""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        keys, results, misses = self._lookup(texts)
+        if misses:
+            self._fill(keys, results, misses, await compute(list(misses.values())))
+        return np.stack(results)
+
+    def _lookup(self, texts: List[str]):
+        """Split texts into cached results and unique misses.
+
+        Returns:
+            The keys, a results list with None for misses, and an ordered
+            mapping of missing keys to their texts.
+        """
+        keys = [self.key(text) for text in texts]
+        results = [None] * len(texts)
+        misses = OrderedDict()
+
+        for i, k in enumerate(keys):
+            embedding = self._entries.get(k)
+            if embedding is not None:
+                self._entries.move_to_end(k)
+                results[i] = embedding
+            elif k not in misses:
+                misses[k] = texts[i]
+
+        return keys, results, misses
+
+    def _fill(self, keys, results, misses, embeddings: np.ndarray):
+        """Store newly computed embeddings and fill them into results."""
+        computed = dict(zip(misses, embeddings))
+        for i, k in enumerate(keys):
+            if results[i] is None:
+                results[i] = computed[k]
+        for k, embedding in computed.items():
+            self._put(k, embedding)
+
+    def _put(self, key: bytes, embedding: np.ndarray):
+        """Store an embedding, evicting the least recently used if full."""
+        if self.max_size <= 0:
+            return
+        # Copy so a cached row doesn't keep its whole batch array alive
+        self._entries[key] = np.array(embedding, dtype=np.float32)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all cached embeddings."""
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
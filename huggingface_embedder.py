@@ -1,10 +1,42 @@
 """Hugging Face API-based embedder for text embeddings."""
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Union
+import asyncio
+import gzip
+import importlib.util
 import os
-import time
+import random
+import httpx
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from urllib3.exceptions import InvalidHeader
+from urllib3.util.retry import Retry
+
+from embedding_cache import EmbeddingCache
+from prompts import BGE_PROMPT
+
+# Limits for a single API request when batching texts
+TOKEN_BUDGET = 2048
+MAX_BATCH_SIZE = 32
+REQUEST_TIMEOUT = 30
+# Number of API requests in flight at once
+MAX_WORKERS = 8
+# Request bodies smaller than this are sent uncompressed
+GZIP_MIN_SIZE = 1024
+# Connection limit for the async client
+MAX_ASYNC_CONNECTIONS = 64
+
+# Retry policy for API requests: exponential backoff plus random jitter so
+# rate-limited workers don't all retry at the same moment
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+BACKOFF_JITTER = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
 class HuggingFaceEmbedder:
     """Embedder using Hugging Face Inference API.
@@ -19,6 +51,8 @@ class HuggingFaceEmbedder:
         dimensions: Optional[int] = 1024,
         api_key: Optional[str] = None,
         api_url: Optional[str] = None,
+        cache_size: int = 50_000,
+        gzip_requests: bool = False,
     ):
         """Initialize the embedder with Hugging Face API configuration.
         
@@ -31,9 +65,17 @@ class HuggingFaceEmbedder:
                 environment variable HUGGINGFACE_API_KEY.
             api_url: Custom API URL if needed. If None, will use the standard
                 Hugging Face Inference API endpoint.
+            cache_size: Number of embeddings kept in the in-process LRU cache.
+                0 disables caching.
+            gzip_requests: Gzip request bodies of at least GZIP_MIN_SIZE bytes.
+                Only enable this for endpoints known to accept
+                Content-Encoding: gzip on requests.
         """
         self.model_name = model_name
         self.dimensions = dimensions
+        self._cache = EmbeddingCache(max_size=cache_size)
+        self._dimensions_validated = False
+        self.gzip_requests = gzip_requests
         
         # Get API key from environment if not provided
         self.api_key = api_key or os.environ.get("HUGGINGFACE_API_KEY")
@@ -45,33 +87,49 @@ class HuggingFaceEmbedder:
         
         # Set up API URL
         self.api_url = api_url or f"https://api-inference.huggingface.co/models/{model_name}"
+
+        # Reuse connections across requests to avoid a TCP/TLS handshake per batch
+        self._session = requests.Session()
+        self._session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        })
+        self._retry_policy = Retry(
+            total=MAX_RETRIES,
+            backoff_factor=BACKOFF_FACTOR,
+            backoff_jitter=BACKOFF_JITTER,
+            backoff_max=BACKOFF_MAX,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=["POST"],
+            # Return the last response so its error details can be reported
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=self._retry_policy)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        # Created by aembed on first use and recreated whenever it is called
+        # from a different event loop, since pooled connections belong to a loop
+        self._aclient: Optional[httpx.AsyncClient] = None
+        self._aclient_loop: Optional[asyncio.AbstractEventLoop] = None
         
         # Test connection to validate API key and model availability
         self._test_connection()
     
     def _test_connection(self):
-        """Test the connection to the Hugging Face API."""
-        headers = {"Authorization": f"Bearer {self.api_key}"}
+        """Test the connection to the Hugging Face API.
+
+        Skipped when dimensions are given, to save a round trip at startup; the
+        first real response is validated by _validate_dimensions instead.
+        """
+        if self.dimensions is not None:
+            return
+
         try:
             # Send a small test request
-            response = requests.post(
-                self.api_url,
-                headers=headers,
-                json={"inputs": "This is a test sentence."},
-            )
+            response = self._post({"inputs": "This is a test sentence."})
             
-            if response.status_code == 200:
-                # If successful, check dimensions if specified
-                if self.dimensions is not None:
-                    result = response.json()
-                    if isinstance(result, list) and len(result) > 0:
-                        actual_dims = len(result[0])
-                        if actual_dims != self.dimensions:
-                            raise ValueError(
-                                f"Model {self.model_name} produces embeddings with {actual_dims} dimensions, "
-                                f"but {self.dimensions} were requested."
-                            )
-            else:
+            if response.status_code != 200:
                 error_msg = f"API test failed with status code {response.status_code}"
                 try:
                     error_details = response.json()
@@ -83,37 +141,130 @@ class HuggingFaceEmbedder:
         except RequestException as e:
             raise ConnectionError(f"Failed to connect to Hugging Face API: {str(e)}")
     
-    def _make_api_request(self, texts, max_retries=3, retry_delay=2):
-        """Make a request to the Hugging Face API with retry logic."""
-        headers = {"Authorization": f"Bearer {self.api_key}"}
-        
-        for attempt in range(max_retries):
+    def _encode_body(self, payload):
+        """Serialize a JSON payload with orjson, returning the body and extra headers.
+
+        With gzip_requests, bodies of at least GZIP_MIN_SIZE bytes are
+        gzip-compressed, since English text compresses well and upload time
+        dominates large batches.
+        """
+        body = orjson.dumps(payload)
+        headers = {}
+        if self.gzip_requests and len(body) >= GZIP_MIN_SIZE:
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    def _post(self, payload) -> requests.Response:
+        """POST a JSON payload to the API."""
+        body, headers = self._encode_body(payload)
+        return self._session.post(
+            self.api_url,
+            data=body,
+            headers=headers,
+            timeout=REQUEST_TIMEOUT,
+        )
+
+    def _make_api_request(self, texts):
+        """Make a request to the Hugging Face API.
+
+        Retries are handled by the session's urllib3 Retry policy.
+        """
+        try:
+            response = self._post({"inputs": texts})
+        except RequestException as e:
+            # Not every RequestException was retried, so don't claim it was
+            raise ConnectionError(f"Failed to connect to Hugging Face API: {str(e)}")
+
+        if response.status_code == 200:
+            return orjson.loads(response.content)
+
+        error_msg = f"API request failed with status code {response.status_code}"
+        try:
+            error_details = response.json()
+            error_msg += f": {error_details}"
+        except:
+            error_msg += f": {response.text}"
+        raise ValueError(error_msg)
+
+    @staticmethod
+    def _backoff_delay(attempt: int) -> float:
+        """Seconds to wait before retrying after the given attempt (0-based)."""
+        delay = BACKOFF_FACTOR * (2 ** attempt) + random.uniform(0, BACKOFF_JITTER)
+        return min(delay, BACKOFF_MAX)
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """Seconds to wait before the next async retry.
+
+        Like urllib3's Retry, a valid Retry-After header on 413/429/503
+        responses takes precedence over the backoff schedule.
+        """
+        if response is not None and response.status_code in Retry.RETRY_AFTER_STATUS_CODES:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return self._retry_policy.parse_retry_after(retry_after)
+                except InvalidHeader:
+                    pass
+        return self._backoff_delay(attempt)
+
+    def _get_aclient(self) -> httpx.AsyncClient:
+        """Return the async HTTP client for the running event loop.
+
+        A client left over from another loop (e.g. an earlier asyncio.run) is
+        dropped rather than closed, as its connections can't be used or closed
+        from this loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._aclient is None or self._aclient_loop is not loop:
+            self._aclient_loop = loop
+            self._aclient = httpx.AsyncClient(
+                headers=dict(self._session.headers),
+                timeout=REQUEST_TIMEOUT,
+                limits=httpx.Limits(max_connections=MAX_ASYNC_CONNECTIONS),
+                # HTTP/2 multiplexes concurrent requests but needs the h2 package
+                http2=importlib.util.find_spec("h2") is not None,
+            )
+        return self._aclient
+
+    async def _amake_api_request(self, texts):
+        """Async version of _make_api_request.
+
+        httpx has no status-based retries, so the session's Retry policy is
+        applied here by hand.
+        """
+        client = self._get_aclient()
+        body, headers = self._encode_body({"inputs": texts})
+
+        for attempt in range(MAX_RETRIES + 1):
             try:
-                response = requests.post(
-                    self.api_url,
-                    headers=headers,
-                    json={"inputs": texts},
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 429:  # Too Many Requests
-                    # Wait longer for rate limit errors
-                    time.sleep(retry_delay * 2 * (attempt + 1))
-                    continue
-                else:
-                    error_msg = f"API request failed with status code {response.status_code}"
-                    try:
-                        error_details = response.json()
-                        error_msg += f": {error_details}"
-                    except:
-                        error_msg += f": {response.text}"
-                    raise ValueError(error_msg)
-                    
-            except RequestException as e:
-                if attempt == max_retries - 1:
-                    raise ConnectionError(f"Failed to connect to Hugging Face API after {max_retries} attempts: {str(e)}")
-                time.sleep(retry_delay * (attempt + 1))
+                response = await client.post(self.api_url, content=body, headers=headers)
+            except httpx.RequestError as e:
+                if attempt == MAX_RETRIES:
+                    raise ConnectionError(f"Failed to connect to Hugging Face API after {MAX_RETRIES} retries: {str(e)}")
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            if response.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                await asyncio.sleep(self._retry_delay(attempt, response))
+                continue
+
+            error_msg = f"API request failed with status code {response.status_code}"
+            try:
+                error_details = response.json()
+                error_msg += f": {error_details}"
+            except:
+                error_msg += f": {response.text}"
+            raise ValueError(error_msg)
+
+    async def aclose(self):
+        """Close the async HTTP client, if one was created on the running loop."""
+        if self._aclient is not None and self._aclient_loop is asyncio.get_running_loop():
+            await self._aclient.aclose()
+        self._aclient = None
+        self._aclient_loop = None
     
     def embed(self, texts: Union[str, List[str]]) -> Union[List[float], List[List[float]]]:
         """Generate embeddings for the given text(s) using Hugging Face API.
@@ -125,26 +276,134 @@ class HuggingFaceEmbedder:
             If a single text is provided, returns a single embedding vector as a list of floats.
             If multiple texts are provided, returns a list of embedding vectors.
         """
+        return self.embed_np(texts).tolist()
+
+    def embed_np(self, texts: Union[str, List[str]]) -> np.ndarray:
+        """Generate embeddings as a float32 array for the given text(s) using Hugging Face API.
+
+        Prefer this over embed when the caller can work with arrays, as it
+        avoids materializing every component as a Python float.
+
+        Args:
+            texts: A single text string or a list of text strings to embed.
+
+        Returns:
+            If a single text is provided, returns a (D,) array.
+            If multiple texts are provided, returns a contiguous (N, D) array.
+        """
         # For BGE models, use the specific prompt template
         if isinstance(texts, str):
             # Single text
-            text_to_embed = f"Represent this sentence for searching relevant passages: {texts}"
-            embeddings = self._make_api_request([text_to_embed])
-            return embeddings[0]
+            text_to_embed = BGE_PROMPT + texts
+            return self._cache.get_or_compute([text_to_embed], self._encode)[0]
         else:
             # List of texts
-            texts_to_embed = [f"Represent this sentence for searching relevant passages: {text}" for text in texts]
-            # Process in batches if there are many texts to avoid API limits
-            if len(texts_to_embed) > 10:
-                # Process in batches of 10
-                all_embeddings = []
-                for i in range(0, len(texts_to_embed), 10):
-                    batch = texts_to_embed[i:i+10]
-                    batch_embeddings = self._make_api_request(batch)
-                    all_embeddings.extend(batch_embeddings)
-                return all_embeddings
-            else:
-                return self._make_api_request(texts_to_embed)
+            if not texts:
+                return np.empty((0, self.get_dimensions()), dtype=np.float32)
+            texts_to_embed = [BGE_PROMPT + text for text in texts]
+            return self._cache.get_or_compute(texts_to_embed, self._encode)
+
+    async def aembed(self, texts: Union[str, List[str]]) -> Union[List[float], List[List[float]]]:
+        """Async version of embed, for callers running in an event loop."""
+        return (await self.aembed_np(texts)).tolist()
+
+    async def aembed_np(self, texts: Union[str, List[str]]) -> np.ndarray:
+        """Async version of embed_np.
+
+        Buckets are sent concurrently over a shared httpx.AsyncClient instead
+        of a thread pool.
+        """
+        if isinstance(texts, str):
+            text_to_embed = BGE_PROMPT + texts
+            return (await self._cache.aget_or_compute([text_to_embed], self._aencode))[0]
+        else:
+            if not texts:
+                return np.empty((0, self.get_dimensions()), dtype=np.float32)
+            texts_to_embed = [BGE_PROMPT + text for text in texts]
+            return await self._cache.aget_or_compute(texts_to_embed, self._aencode)
+
+    def _encode(self, texts_to_embed: List[str]) -> np.ndarray:
+        """Embed texts via the API into a (N, D) float32 array."""
+        embeddings = self._bucket_and_send(texts_to_embed)
+        self._validate_dimensions(embeddings)
+        return embeddings
+
+    async def _aencode(self, texts_to_embed: List[str]) -> np.ndarray:
+        """Async version of _encode."""
+        buckets = self._make_buckets(texts_to_embed)
+        results = await asyncio.gather(*(
+            self._amake_api_request([texts_to_embed[i] for i in bucket]) for bucket in buckets
+        ))
+        embeddings = self._scatter(len(texts_to_embed), buckets, results)
+        self._validate_dimensions(embeddings)
+        return embeddings
+
+    def _validate_dimensions(self, embeddings: np.ndarray):
+        """Check the first API response against the expected dimensions."""
+        if self._dimensions_validated or self.dimensions is None:
+            return
+
+        actual_dims = embeddings.shape[-1]
+        if actual_dims != self.dimensions:
+            raise ValueError(
+                f"Model {self.model_name} produces embeddings with {actual_dims} dimensions, "
+                f"but {self.dimensions} were requested."
+            )
+        self._dimensions_validated = True
+
+    @staticmethod
+    def _make_buckets(texts_to_embed: List[str]) -> List[List[int]]:
+        """Group text indices into length-sorted buckets for batched requests.
+
+        Texts are sorted by whitespace token count and packed greedily into
+        buckets of at most TOKEN_BUDGET tokens and MAX_BATCH_SIZE texts, so that
+        texts of similar length share a request and server-side padding is small.
+        """
+        lens = [len(text.split()) for text in texts_to_embed]
+        order = sorted(range(len(texts_to_embed)), key=lens.__getitem__)
+
+        buckets = []
+        bucket, bucket_tokens = [], 0
+        for i in order:
+            if bucket and (bucket_tokens + lens[i] > TOKEN_BUDGET or len(bucket) >= MAX_BATCH_SIZE):
+                buckets.append(bucket)
+                bucket, bucket_tokens = [], 0
+            bucket.append(i)
+            bucket_tokens += lens[i]
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    @staticmethod
+    def _scatter(n: int, buckets: List[List[int]], results) -> np.ndarray:
+        """Reassemble per-bucket results into an (n, D) float32 array in input order.
+
+        Each bucket is converted with a single np.asarray call and written into
+        its rows with fancy indexing, rather than placing vectors one by one.
+        """
+        embeddings = None
+        for bucket, batch_embeddings in zip(buckets, results):
+            batch_embeddings = np.asarray(batch_embeddings, dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.empty((n, batch_embeddings.shape[-1]), dtype=np.float32)
+            embeddings[bucket] = batch_embeddings
+        return embeddings
+
+    def _bucket_and_send(self, texts_to_embed: List[str]) -> np.ndarray:
+        """Embed texts in length-sorted buckets, returning results in input order.
+
+        Buckets are sent concurrently on up to MAX_WORKERS threads.
+        """
+        buckets = self._make_buckets(texts_to_embed)
+        batches = [[texts_to_embed[i] for i in bucket] for bucket in buckets]
+        if len(batches) > 1:
+            # Requests are independent and I/O bound, so send them concurrently
+            with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(batches))) as executor:
+                results = list(executor.map(self._make_api_request, batches))
+        else:
+            results = [self._make_api_request(batch) for batch in batches]
+
+        return self._scatter(len(texts_to_embed), buckets, results)
     
     def get_dimensions(self) -> int:
         """Get the dimensions of the embeddings produced by this model."""
@@ -0,0 +1,4 @@
+"""Prompt templates shared by the embedders."""
+
+# Query instruction BGE models expect in front of each text
+BGE_PROMPT = "Represent this sentence for searching relevant passages: "